@@ -1,70 +1,381 @@
+import functools
+import os
+import subprocess
+import tempfile
+
+import casadi as cs
+import cffi
 import numpy as np
 import optas
+from numba import njit
 from robot import load_robot
 
+# Options for the supported QP solvers. OSQP is warm started through CasADi,
+# however the Hessian depends on the current joint position and so it must be
+# refactorized every cycle. For this small dense problem the active-set solvers
+# qpOASES and qrqp are faster.
+QP_SOLVER_OPTIONS = {
+    "qpoases": {
+        "sparse": True,
+        "hessian_type": "posdef",
+        "enableEqualities": True,
+        "terminationTolerance": 1e-6,
+        "printLevel": "none",
+    },
+    "qrqp": {"print_header": False, "print_iter": False, "print_info": False},
+    "osqp": {
+        "warm_start_primal": True,
+        "warm_start_dual": True,
+        "osqp": {
+            "verbose": False,
+            "polish": False,
+            "eps_abs": 1e-3,
+            "eps_rel": 1e-3,
+            "max_iter": 50,
+            "adaptive_rho": False,
+            "rho": 0.1,
+        },
+    },
+}
+
+# QP solvers that generate self-contained C code, i.e. with static memory and
+# no dependency on the CasADi runtime
+CODEGEN_QP_SOLVERS = {"qrqp"}
+
+
+def _buffer(function, args, res):
+    # Bind preallocated NumPy arrays to the named inputs/outputs of a CasADi
+    # function, the returned callable evaluates it in place. Only pointers are
+    # stored, so the caller must keep the arrays alive.
+    buf, evaluate = function.buffer()
+    for name, x in args.items():
+        buf.set_arg(function.index_in(name), memoryview(x))
+    for name, x in res.items():
+        buf.set_res(function.index_out(name), memoryview(x))
+    return buf, evaluate
+
+
+def _compile(function, args, res):
+    # Generate C code for a CasADi function, compile it to a shared library and
+    # load it with cffi. Like _buffer, the returned callable evaluates the
+    # function in place on the given NumPy arrays. Note, -ffast-math is not used
+    # since the solver relies on infinite bounds.
+    name = function.name()
+    ffi = cffi.FFI()
+    ffi.cdef(f"""
+        int {name}(const double** arg, double** res, long long* iw, double* w, int mem);
+        void {name}_incref(void);
+        int {name}_checkout(void);
+        """)
+
+    # The build directory is removed once the library is loaded
+    with tempfile.TemporaryDirectory(prefix=f"{name}_") as build_dir:
+        c_file = os.path.join(build_dir, f"{name}.c")
+        lib_file = os.path.join(build_dir, f"{name}.so")
+        codegen = cs.CodeGenerator(f"{name}.c", {"with_header": True})
+        codegen.add(function)
+        codegen.generate(build_dir + os.sep)
+        flags = ["-O3", "-march=native", "-fPIC", "-pthread", "-shared"]
+        subprocess.run(
+            [os.environ.get("CC", "cc"), *flags, c_file, "-o", lib_file, "-lm"],
+            check=True,
+        )
+        lib = ffi.dlopen(lib_file)
+    getattr(lib, f"{name}_incref")()
+    mem = getattr(lib, f"{name}_checkout")()
+
+    arg = ffi.new("const double*[]", function.sz_arg())
+    for i, x in args.items():
+        arg[function.index_in(i)] = ffi.from_buffer("double[]", x)
+    res_ = ffi.new("double*[]", function.sz_res())
+    for i, x in res.items():
+        res_[function.index_out(i)] = ffi.from_buffer("double[]", x)
+    iw = ffi.new("long long[]", function.sz_iw())
+    w = ffi.new("double[]", function.sz_w())
+
+    evaluate = functools.partial(getattr(lib, name), arg, res_, iw, w, mem)
+    return lib, evaluate
+
+
+@njit(cache=True)
+def _set_parameters(
+    qc, wr, dt, gain, lower, upper, threshold, p, x0, lam_x0, lam_a0, jumped
+):
+    # Fill the parameter vector p = [qc; vg; dt] of each robot in place, flags
+    # the robots whose joint position jumped and returns True if there are any
+    any_jumped = False
+    ndof = qc.shape[0]
+    for j in range(qc.shape[1]):
+        # Current joint position, the warm start is dropped for robots whose
+        # joint position jumped (e.g. after fault recovery) since a stale
+        # active set would cost more iterations than a cold start. Note, p is
+        # NaN before the first call.
+        jumped[j] = False
+        dist = 0.0
+        for i in range(ndof):
+            dist += (qc[i, j] - p[j, i]) ** 2
+            p[j, i] = qc[i, j]
+        if not dist <= threshold * threshold:
+            x0[j, :] = 0.0
+            lam_x0[j, :] = 0.0
+            lam_a0[j, :] = 0.0
+            if dist > threshold * threshold:
+                jumped[j] = True
+                any_jumped = True
+
+        # Admittance control: map force -> velocity, clipped for safety
+        for i in range(6):
+            p[j, ndof + i] = min(max(gain[i] * wr[i, j], lower[i]), upper[i])
+
+        # Time step
+        p[j, ndof + 6] = dt
+
+    return any_jumped
+
+
+@njit(cache=True, fastmath=True)
+def _integrate(qc, dt, dqg, out):
+    for j in range(out.shape[1]):
+        for i in range(out.shape[0]):
+            out[i, j] = qc[i, j] + dt * dqg[i, j]
+
 
 class AdmittanceController:
-    def __init__(self, lbr_med_num):
+    def __init__(
+        self,
+        lbr_med_num,
+        qp_solver="qpoases",
+        codegen=False,
+        num_robots=1,
+        parallelization="serial",
+        warm_start_threshold=0.1,
+    ):
+        if warm_start_threshold <= 0.0:
+            raise ValueError("warm_start_threshold must be positive")
+        if codegen and qp_solver not in CODEGEN_QP_SOLVERS:
+            raise ValueError(
+                f"QP solver '{qp_solver}' does not support code generation"
+            )
+
         # Setup robot
         self.ee_link = "lbr_link_ee"
         self.robot = load_robot(lbr_med_num, [1])
         self.name = self.robot.get_name()
+        ndof = self.robot.ndof
+        self._ndof = ndof
+        self._num_robots = num_robots
 
-        # Setup builder
-        T = 1
-        builder = optas.OptimizationBuilder(T, robots=self.robot, derivs_align=True)
+        # Set parameters, p = [qc; vg; dt]
+        p = cs.SX.sym("p", ndof + 7)
+        qc = p[:ndof]  # current joint position
+        vg = p[ndof : ndof + 6]  # task space velocity goal: [vx, vy, vz, wx, wy, wz]
+        dt = p[ndof + 6]  # time step
 
-        # Set parameters
-        qc = builder.add_parameter("qc", self.robot.ndof)  # current joint position
-        vg = builder.add_parameter(
-            "vg", 6
-        )  # task space velocity goal: [vx, vy, vz, wx, wy, wz]
-        dt = builder.add_parameter("dt")  # time step
+        # Cost: end-effector goal velocity, written directly in the QP form
+        # 0.5*dq'*H*dq + g'*dq. The Jacobian is sparsified to drop structural
+        # zeros so that J'*J is built from fewer operations.
+        J = self.robot.get_global_link_geometric_jacobian(self.ee_link, qc)
+        J = cs.sparsify(J)
+        H = 100.0 * optas.mtimes(J.T, J)
+        g = -100.0 * optas.mtimes(J.T, vg)
 
-        # Get model states
-        dq = builder.get_model_state(self.name, t=0, time_deriv=1)
+        # Cost: minimize joint velocity, i.e. ||dq||^2 = 0.5*dq'*(2*I)*dq
+        H += 2.0 * cs.DM.eye(ndof)
 
-        # Cost: end-effector goal velocity
-        J = self.robot.get_global_link_geometric_jacobian(self.ee_link, qc)
-        v = J @ dq
-        builder.add_cost_term("ee_vel_goal", 50.0 * optas.sumsqr(v - vg))
-
-        # Constraint: joint limits
-        q = qc + dt * dq
-        builder.add_bound_inequality_constraint(
-            "joint_limits",
-            self.robot.lower_actuated_joint_limits,
-            q,
-            self.robot.upper_actuated_joint_limits,
+        # Constraint: joint limits, lba <= A*dq <= uba
+        A = dt * cs.SX.eye(ndof)
+        lba = self.robot.lower_actuated_joint_limits - qc
+        uba = self.robot.upper_actuated_joint_limits - qc
+
+        # Generate QP data function, the dimensions are fixed for the robot so
+        # it is compiled once with common subexpression elimination into
+        # straight-line code that the compiler can vectorize. When no
+        # GCC-compatible compiler is available (set with CC) the function is
+        # evaluated by the CasADi virtual machine instead.
+        qp_data_args = (
+            "qp_data",
+            [p],
+            [H, g, A, lba, uba],
+            ["p"],
+            ["h", "g", "a", "lba", "uba"],
+        )
+        qp_data_jit_options = {
+            "jit": True,
+            "compiler": "shell",
+            "jit_options": {
+                "compiler": os.environ.get("CC", "gcc"),
+                "flags": ["-O3", "-march=native", "-ffast-math", "-funroll-loops"],
+            },
+        }
+        try:
+            self.qp_data = cs.Function(
+                *qp_data_args, {"cse": True, **qp_data_jit_options}
+            )
+        except RuntimeError:
+            print("Compiling the QP data failed, falling back to the CasADi VM.")
+            self.qp_data = cs.Function(*qp_data_args, {"cse": True})
+
+        # Setup solvers. qpOASES ignores the warm start seeds and instead
+        # hot-starts from the active set kept in its solver memory, so every
+        # robot gets its own instance which are solved one after another. The
+        # other solvers use the per-robot seeds, a single instance is mapped
+        # over the robots.
+        self._qp_solver = qp_solver
+        self._qp = {"h": H.sparsity(), "a": A.sparsity()}
+        self._hot_start = qp_solver == "qpoases"
+        if self._hot_start and num_robots > 1 and parallelization != "serial":
+            raise ValueError(
+                f"QP solver '{qp_solver}' only supports serial parallelization"
+            )
+        num_solvers = num_robots if self._hot_start else 1
+        self.solvers = [self._conic() for _ in range(num_solvers)]
+
+        self.gain = np.ascontiguousarray(
+            [0.05, 0.05, 0.05, 0.3, 0.3, 0.3], dtype=np.float64
+        )
+        self.vlim = np.ascontiguousarray(
+            np.concatenate(([0.2, 0.2, 0.2], np.deg2rad([40] * 3))), dtype=np.float64
         )
+        self._neg_vlim = -self.vlim
+        self._warm_start_threshold = warm_start_threshold
 
-        # Cost: minimize joint velocity
-        builder.add_cost_term("min_joint_vel", optas.sumsqr(dq))
+        # Preallocate buffers, one row per robot which matches the column-major
+        # layout of the stacked (., num_robots) CasADi inputs/outputs
+        self._p_buf = np.full((num_robots, ndof + 7), np.nan)
+        self._qg_buf = np.empty((num_robots, ndof))
+        self._dq_buf = np.zeros((num_robots, ndof))
+        self._lam_x_buf = np.zeros((num_robots, ndof))
+        self._lam_a_buf = np.zeros((num_robots, ndof))
+        self._jumped_buf = np.zeros(num_robots, dtype=np.bool_)
 
-        # Setup solver
-        opt = builder.build()
-        solver_options = {"printLevel": "none"}
-        self.solver = optas.CasADiSolver(opt).setup("qpoases", solver_options)
-        self.solution = None
-        self.gain = np.array([0.05, 0.05, 0.05, 0.3, 0.3, 0.3])
-        self.vlim = np.concatenate(([0.2, 0.2, 0.2], np.deg2rad([40] * 3)))
+        self._codegen = codegen
+        self._parallelization = parallelization
+        self._setup_step()
+
+        # Stacked (., num_robots) views of the buffers, a single vector is
+        # returned when controlling one robot
+        self._dq_view = self._dq_buf.T
+        self._qg_view = self._qg_buf.T
+        self._qg_out = self._qg_view[:, 0] if num_robots == 1 else self._qg_view
+
+    def _conic(self):
+        return cs.conic(
+            "solver", self._qp_solver, self._qp, QP_SOLVER_OPTIONS[self._qp_solver]
+        )
+
+    def _setup_step(self):
+        # Compose the QP data and solvers into a single function, the inputs and
+        # outputs are stacked column-wise for each solver. The solution is fed
+        # back in to warm start the next solve. Note, the seeds are only used by
+        # qrqp and OSQP, qpOASES ignores them and instead hot-starts from the
+        # active set kept in its solver memory.
+        ndof = self._ndof
+        num_solvers = len(self.solvers)
+        args = {
+            "p": cs.MX.sym("p", ndof + 7, num_solvers),
+            "x0": cs.MX.sym("x0", ndof, num_solvers),
+            "lam_x0": cs.MX.sym("lam_x0", ndof, num_solvers),
+            "lam_a0": cs.MX.sym("lam_a0", ndof, num_solvers),
+        }
+        res = {"x": [], "lam_x": [], "lam_a": []}
+        for j, solver in enumerate(self.solvers):
+            qp = self.qp_data(p=args["p"][:, j])
+            solution = solver(
+                **qp,
+                lbx=-cs.inf,
+                ubx=cs.inf,
+                x0=args["x0"][:, j],
+                lam_x0=args["lam_x0"][:, j],
+                lam_a0=args["lam_a0"][:, j],
+            )
+            for name, sol in res.items():
+                sol.append(solution[name])
+        self.step = cs.Function(
+            "admittance_qp",
+            list(args.values()),
+            [cs.horzcat(*sol) for sol in res.values()],
+            list(args),
+            list(res),
+        )
+
+        # Batch the QPs for multiple robots into one call. Note, "thread" starts
+        # new threads on every call which costs more than solving these small
+        # QPs, hence "serial" is the default.
+        step = self.step
+        if num_solvers < self._num_robots:
+            step = self.step.map(
+                "admittance_qp_map",
+                self._parallelization,
+                self._num_robots,
+                [],
+                [],
+                {"max_num_threads": os.cpu_count()},
+            )
+
+        step_args = {
+            "p": self._p_buf,
+            "x0": self._dq_buf,
+            "lam_x0": self._lam_x_buf,
+            "lam_a0": self._lam_a_buf,
+        }
+        step_res = {
+            "x": self._dq_buf,
+            "lam_x": self._lam_x_buf,
+            "lam_a": self._lam_a_buf,
+        }
+        if self._codegen:
+            self._step_lib, self._step_eval = _compile(step, step_args, step_res)
+        else:
+            self._step_buf, self._step_eval = _buffer(step, step_args, step_res)
 
     def __call__(self, qc, wr, dt):
-        # Admittance control: map force -> velocity
-        vg = self.gain * wr
+        # Inputs are either vectors for a single robot or stacked column-wise
+        # for each robot
+        qc = np.asarray(qc, dtype=np.float64)
+        wr = np.asarray(wr, dtype=np.float64)
+        if self._num_robots == 1:
+            qc = qc.reshape(-1, 1) if qc.ndim == 1 else qc
+            wr = wr.reshape(-1, 1) if wr.ndim == 1 else wr
+        if qc.shape != (self._ndof, self._num_robots):
+            raise ValueError(
+                f"Expected qc of shape ({self._ndof}, {self._num_robots}), got {qc.shape}"
+            )
+        if wr.shape != (6, self._num_robots):
+            raise ValueError(
+                f"Expected wr of shape (6, {self._num_robots}), got {wr.shape}"
+            )
 
-        # Clip velocity (safety)
-        vg = np.clip(vg, -self.vlim, self.vlim)
+        # Set parameters, drops the warm start when the joint position jumped
+        jumped = _set_parameters(
+            qc,
+            wr,
+            dt,
+            self.gain,
+            self._neg_vlim,
+            self.vlim,
+            self._warm_start_threshold,
+            self._p_buf,
+            self._dq_buf,
+            self._lam_x_buf,
+            self._lam_a_buf,
+            self._jumped_buf,
+        )
 
-        # Setup solver
-        if self.solution is not None:
-            self.solver.reset_initial_seed(self.solution)
+        # qpOASES hot-starts from the active set kept in its solver memory,
+        # which cannot be reset. Instead, the solvers of the robots whose joint
+        # position jumped are replaced by new instances, this is slow but jumps
+        # are rare.
+        if jumped and self._hot_start:
+            for j in np.flatnonzero(self._jumped_buf):
+                self.solvers[j] = self._conic()
+            self._setup_step()
 
-        self.solver.reset_parameters({"qc": qc, "vg": vg, "dt": dt})
+        # Solve problem, the solution is written to self._dq_buf. The generated
+        # code returns a non-zero flag instead of raising when the solve fails.
+        if self._step_eval():
+            raise RuntimeError("Solving the admittance QP failed.")
 
-        # Solve problem and retrieve solution
-        self.solution = self.solver.solve()
-        dqg = self.solution[f"{self.name}/dq"].toarray().flatten()
-        qg = qc + dt * dqg
+        # Note, the returned array is reused on the next call
+        _integrate(qc, dt, self._dq_view, self._qg_view)
 
-        return qg
+        return self._qg_out
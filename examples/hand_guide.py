@@ -19,9 +19,9 @@ elif fri.FRI_CLIENT_VERSION_MAJOR == 2:
 
 
 class HandGuideClient(fri.LBRClient):
-    def __init__(self, lbr_ver):
+    def __init__(self, lbr_ver, qp_solver, codegen):
         super().__init__()
-        self.controller = AdmittanceController(lbr_ver)
+        self.controller = AdmittanceController(lbr_ver, qp_solver, codegen)
         self.joint_state_estimator = JointStateEstimator(self)
         self.external_torque_estimator = FRIExternalTorqueEstimator(self)
         self.wrench_estimator = WrenchEstimatorTaskOffset(
@@ -95,6 +95,20 @@ def args_factory():
         required=True,
         help="The KUKA LBR Med version number.",
     )
+    parser.add_argument(
+        "--qp-solver",
+        dest="qp_solver",
+        type=str,
+        choices=["qpoases", "qrqp", "osqp"],
+        default="qpoases",
+        help="The QP solver used by the admittance controller.",
+    )
+    parser.add_argument(
+        "--codegen",
+        dest="codegen",
+        action="store_true",
+        help="Generate and compile C code for the admittance controller QP (requires --qp-solver qrqp).",
+    )
 
     return parser.parse_args()
 
@@ -103,7 +117,7 @@ def main():
     print("Running FRI Version:", fri.FRI_CLIENT_VERSION)
 
     args = args_factory()
-    client = HandGuideClient(args.lbr_ver)
+    client = HandGuideClient(args.lbr_ver, args.qp_solver, args.codegen)
     app = fri.ClientApplication(client)
     success = app.connect(args.port, args.hostname)
 
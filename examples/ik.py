@@ -38,6 +38,7 @@ class IK:
         ee_link = "lbr_link_ee"
         self.robot = load_robot(lbr_med_num, [0, 1])
         self.name = self.robot.get_name()
+        self._q_key = f"{self.name}/q"
 
         # Setup builder
         T = 2
@@ -80,7 +81,7 @@ class IK:
         if self.solution is not None:
             self.solver.reset_initial_seed(self.solution)
         else:
-            self.solver.reset_initial_seed({f"{self.name}/q": optas.horzcat(qc, qc)})
+            self.solver.reset_initial_seed({self._q_key: optas.horzcat(qc, qc)})
 
         # Reset parameters
         self.solver.reset_parameters({"qc": qc, "vg": vg, "dt": dt})
@@ -90,7 +91,7 @@ class IK:
 
         # Return solution or current position if solver failed
         if self.solver.did_solve():
-            return self.solution[f"{self.name}/q"][:, 1].toarray().flatten()
+            return self.solution[self._q_key][:, 1].toarray().flatten()
         else:
             print("[WARN] solver failed!")
             return qc
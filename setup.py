@@ -1,8 +1,11 @@
+import hashlib
 import os
 import re
+import shutil
 import subprocess
 import sys
 from pathlib import Path
+from typing import Optional
 
 from setuptools import Extension, find_packages, setup
 from setuptools.command.build_ext import build_ext
@@ -28,6 +31,14 @@ PLAT_TO_CMAKE = {
     "win-arm64": "ARM64",
 }
 
+# Convert distutils Windows platform specifiers to vcvarsall.bat architectures
+PLAT_TO_MSVC_ARCH = {
+    "win32": "x86",
+    "win-amd64": "amd64",
+    "win-arm32": "arm",
+    "win-arm64": "arm64",
+}
+
 
 # A CMakeExtension needs a sourcedir instead of a file list.
 # The name must be the _single_ output extension from the CMake build.
@@ -70,27 +81,52 @@ class CMakeBuild(build_ext):
         # In this example, we pass in the version to C++. You might not need to.
         # cmake_args += [f"-DEXAMPLE_VERSION_INFO={self.distribution.get_version()}"]
 
-        if self.compiler.compiler_type != "msvc":
-            # Using Ninja-build since it a) is available as a wheel and b)
-            # multithreads automatically. MSVC would require all variables be
-            # exported for Ninja to pick it up, which is a little tricky to do.
-            # Users can override the generator with CMAKE_GENERATOR in CMake
-            # 3.15+.
-            if not cmake_generator or cmake_generator == "Ninja":
-                try:
-                    import ninja
-
-                    ninja_executable_path = Path(ninja.BIN_DIR) / "ninja"
-                    cmake_args += [
-                        "-GNinja",
-                        f"-DCMAKE_MAKE_PROGRAM:FILEPATH={ninja_executable_path}",
-                    ]
-                except ImportError:
-                    pass
-
-        else:
+        # Environment for the CMake calls
+        env = os.environ.copy()
+
+        # Using Ninja-build since it a) is available as a wheel and b)
+        # multithreads automatically. MSVC requires all variables be exported
+        # for Ninja to pick it up, when not run from a developer command prompt
+        # they are retrieved from vcvarsall.bat. Users can override the
+        # generator with CMAKE_GENERATOR in CMake 3.15+.
+        if not cmake_generator or cmake_generator.startswith("Ninja"):
+            try:
+                import ninja
+
+                ninja_executable_path = Path(ninja.BIN_DIR) / "ninja"
+            except ImportError:
+                ninja_executable_path = None
+
+            # The Ninja Multi-Config generator used for MSVC requires CMake
+            # 3.17+, older versions fall back to the Visual Studio generators
+            msvc_env = {}
+            if ninja_executable_path and self.compiler.compiler_type == "msvc":
+                if not cmake_generator and self._cmake_version() < (3, 17):
+                    ninja_executable_path = None
+                else:
+                    msvc_env = self._msvc_env()
+
+            if ninja_executable_path and msvc_env is not None:
+                env.update(msvc_env)
+                if not cmake_generator:
+                    if self.compiler.compiler_type == "msvc":
+                        cmake_generator = "Ninja Multi-Config"
+                    else:
+                        cmake_generator = "Ninja"
+                cmake_args += [
+                    f"-G{cmake_generator}",
+                    f"-DCMAKE_MAKE_PROGRAM:FILEPATH={ninja_executable_path}",
+                ]
+
+        if self.compiler.compiler_type == "msvc":
             # Single config generators are handled "normally"
-            single_config = any(x in cmake_generator for x in {"NMake", "Ninja"})
+            single_config = (
+                any(x in cmake_generator for x in {"NMake", "Ninja"})
+                and "Multi-Config" not in cmake_generator
+            )
+
+            # Only the Visual Studio generators accept a platform
+            vs_generator = not any(x in cmake_generator for x in {"NMake", "Ninja"})
 
             # CMake allows an arch-in-generator style for backward compatibility
             contains_arch = any(x in cmake_generator for x in {"ARM", "Win64"})
@@ -98,7 +134,7 @@ class CMakeBuild(build_ext):
             # Specify the arch if using MSVC generator, but only if it doesn't
             # contain a backward-compatibility arch spec already in the
             # generator name.
-            if not single_config and not contains_arch:
+            if vs_generator and not contains_arch:
                 cmake_args += ["-A", PLAT_TO_CMAKE[self.plat_name]]
 
             # Multi-config generators have a different way to specify configs
@@ -122,6 +158,57 @@ class CMakeBuild(build_ext):
             if hasattr(self, "parallel") and self.parallel:
                 # CMake 3.12+ only.
                 build_args += [f"-j{self.parallel}"]
+            else:
+                env["CMAKE_BUILD_PARALLEL_LEVEL"] = str(os.cpu_count())
+
+        # Optional profile-guided optimization (GCC/Clang only). When FRI_PGO=1
+        # the first build is instrumented, running it (e.g. an example on the
+        # robot) writes profile data to FRI_PGO_DIR, and the next build with
+        # FRI_PGO=1 uses this profile data. GCC writes *.gcda files that are
+        # used directly, Clang writes *.profraw files that are first merged
+        # into default.profdata with llvm-profdata.
+        if os.environ.get("FRI_PGO", "0") == "1":
+            if self.compiler.compiler_type == "msvc":
+                raise UserInputRequired("FRI_PGO is not supported with MSVC.")
+            pgo_dir = Path(
+                os.environ.get("FRI_PGO_DIR", Path(ext.sourcedir) / "build" / "pgo")
+            ).resolve()
+            profraw_files = sorted(pgo_dir.glob("*.profraw"))
+            if profraw_files:
+                subprocess.run(
+                    [
+                        *self._llvm_profdata(),
+                        "merge",
+                        f"-output={pgo_dir / 'default.profdata'}",
+                        *profraw_files,
+                    ],
+                    check=True,
+                )
+            if any(pgo_dir.rglob("*.gcda")):
+                pgo_flags = f"-fprofile-use={pgo_dir} -fprofile-correction"
+            elif (pgo_dir / "default.profdata").exists():
+                pgo_flags = f"-fprofile-use={pgo_dir}"
+            else:
+                pgo_dir.mkdir(parents=True, exist_ok=True)
+                pgo_flags = f"-fprofile-generate={pgo_dir}"
+            cmake_args += [
+                f"-DCMAKE_C_FLAGS={os.environ.get('CFLAGS', '')} {pgo_flags}",
+                f"-DCMAKE_CXX_FLAGS={os.environ.get('CXXFLAGS', '')} {pgo_flags}",
+                f"-DCMAKE_MODULE_LINKER_FLAGS={pgo_flags}",
+                f"-DCMAKE_SHARED_LINKER_FLAGS={pgo_flags}",
+            ]
+
+        # Use a compiler cache when available to speed up rebuilds, set
+        # FRI_USE_CCACHE=0 to disable
+        if os.environ.get("FRI_USE_CCACHE", "1") == "1" and not any(
+            "COMPILER_LAUNCHER" in arg for arg in cmake_args
+        ):
+            launcher = shutil.which("ccache") or shutil.which("sccache")
+            if launcher:
+                cmake_args += [
+                    f"-DCMAKE_C_COMPILER_LAUNCHER={launcher}",
+                    f"-DCMAKE_CXX_COMPILER_LAUNCHER={launcher}",
+                ]
 
         # Set the FRI version number
         fri_ver_major = FRI_CLIENT_VERSION.split(".")[0]
@@ -133,13 +220,76 @@ class CMakeBuild(build_ext):
         if not build_temp.exists():
             build_temp.mkdir(parents=True)
 
-        subprocess.run(
-            ["cmake", ext.sourcedir, *cmake_args], cwd=build_temp, check=True
+        # Skip the configure step when the build tree was configured with the
+        # same arguments, cmake --build re-runs it if CMakeLists.txt changed.
+        # Set FRI_FORCE_RECONFIGURE=1 to always configure.
+        cmake_args_hash = hashlib.sha256(
+            "\n".join([ext.sourcedir, *sorted(cmake_args)]).encode()
+        ).hexdigest()
+        cmake_args_hash_file = build_temp / ".cmake_args_hash"
+        reconfigure = (
+            os.environ.get("FRI_FORCE_RECONFIGURE", "0") == "1"
+            or not (build_temp / "CMakeCache.txt").exists()
+            or not cmake_args_hash_file.exists()
+            or cmake_args_hash_file.read_text() != cmake_args_hash
         )
+
+        if reconfigure:
+            # Configure from scratch (like --fresh in CMake 3.24+), otherwise
+            # options that are no longer passed, e.g. the PGO flags or the
+            # compiler launcher, would persist in the cache
+            cmake_args_hash_file.unlink(missing_ok=True)
+            (build_temp / "CMakeCache.txt").unlink(missing_ok=True)
+            shutil.rmtree(build_temp / "CMakeFiles", ignore_errors=True)
+            subprocess.run(
+                ["cmake", ext.sourcedir, *cmake_args],
+                cwd=build_temp,
+                env=env,
+                check=True,
+            )
+            cmake_args_hash_file.write_text(cmake_args_hash)
+
         subprocess.run(
-            ["cmake", "--build", ".", *build_args], cwd=build_temp, check=True
+            ["cmake", "--build", ".", *build_args], cwd=build_temp, env=env, check=True
+        )
+
+    def _cmake_version(self) -> tuple:
+        output = subprocess.run(
+            ["cmake", "--version"], capture_output=True, text=True, check=True
+        ).stdout
+        match = re.search(r"version (\d+)\.(\d+)", output)
+        return tuple(int(x) for x in match.groups())
+
+    def _llvm_profdata(self) -> list:
+        # Command to merge Clang profile data, LLVM_PROFDATA overrides the
+        # llvm-profdata found on the PATH (or via xcrun for AppleClang)
+        if "LLVM_PROFDATA" in os.environ:
+            return [os.environ["LLVM_PROFDATA"]]
+        if shutil.which("llvm-profdata"):
+            return ["llvm-profdata"]
+        if sys.platform.startswith("darwin") and shutil.which("xcrun"):
+            return ["xcrun", "llvm-profdata"]
+        raise UserInputRequired(
+            "Found Clang profile data but not llvm-profdata, please set the environment variable LLVM_PROFDATA to the llvm-profdata executable."
         )
 
+    def _msvc_env(self) -> Optional[dict]:
+        # Nothing to do when run from a developer command prompt
+        if "VCINSTALLDIR" in os.environ:
+            return {}
+
+        # Otherwise retrieve the variables set by vcvarsall.bat, None when
+        # MSVC could not be found
+        try:
+            from setuptools.msvc import EnvironmentInfo
+
+            arch = PLAT_TO_MSVC_ARCH[self.plat_name]
+            vc_env = EnvironmentInfo(arch).return_env()
+        except Exception:
+            return None
+
+        return {key.upper(): value for key, value in vc_env.items()}
+
 
 setup(
     name="pyfri",
@@ -150,7 +300,15 @@ setup(
     long_description="",
     packages=find_packages(),
     ext_modules=[CMakeExtension("_pyfri")],
-    install_requires=["numpy", "pygame", "pyoptas", "pandas", "matplotlib"],
+    install_requires=[
+        "numpy",
+        "numba",
+        "cffi",
+        "pygame",
+        "pyoptas",
+        "pandas",
+        "matplotlib",
+    ],
     cmdclass={"build_ext": CMakeBuild},
     python_requires=">=3.8",
 )